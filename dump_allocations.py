@@ -8,11 +8,11 @@ def dump(instrumentId=None, url=None, token=None, directory=None):
             "allocations": allocations,
         }
 
-        print(f"Saving data to '{directory}/data.yaml'")
+        log.info(f"Saving data to '{directory}/data.yaml'")
         dict_to_yaml(data_to_yaml, f"{directory}/data.yaml")
 
     else:
-        print(f"Error: no allocations found using instrumendId: {instrumentId}")
+        log.error(f"Error: no allocations found using instrumendId: {instrumentId}")
 
 def main():
     parser = argparse.ArgumentParser(description="Dump SkyPortal allocations.")
@@ -20,8 +20,10 @@ def main():
     parser.add_argument("--url", help="The url of the Skyportal instance.", type=str)
     parser.add_argument("--token", help="The token of the Skyportal instance.", type=str)
     parser.add_argument("--use_config", help="Use config file to get parameters. Use it if you want to use the config file rather than providing parameters in the command line.", action="store_true")
+    parser.add_argument("--verbose", help="Show the progress of the dump.", action="store_true")
     parser.add_argument("--directory", help="Directory to save results to. If not provided, a random directory name in results/ will be used.", type=str)
     args = parser.parse_args()
+    setup_logging(args.verbose)
 
     use_config = args.use_config
     if use_config is True:
@@ -31,7 +33,7 @@ def main():
             url = config["skyportal_url"]
             token = config["skyportal_token"]
         except KeyError as e:
-            print("Error: {} not found in config file.".format(e))
+            log.error("Error: {} not found in config file.".format(e))
             return
     else:
         instrumentId = args.instrumentId
@@ -39,23 +41,7 @@ def main():
         token = args.token
 
 
-    if args.directory is None:
-        dir = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-        directory = f"results/{dir}"
-        counter = 1
-        while os.path.exists(directory):
-            directory = f"results/{dir}_{counter}"
-            counter += 1
-        if not os.path.exists("results"):
-            os.makedirs("results")
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-    else:
-        directory = args.directory
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-    if not os.path.exists(directory):
-        os.makedirs(directory)
+    directory = make_results_directory(datetime.now().strftime('%Y-%m-%d_%H-%M-%S'), args.directory)
 
     dump(instrumentId, url, token, directory)
 
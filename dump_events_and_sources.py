@@ -1,65 +1,94 @@
 from utils import *
         
-def dump(localizationDateobs: str = None, localizationName: str = None, startDate: str = None, endDate: str = None, localizationCumprob: float = 0.95, numberDetections: int = 2, numPerPage: int = 100, url: str = None, token: str = None, whitelisted: bool = False, directory: str = None):
+def dump(localizationDateobs: str = None, localizationName: str = None, startDate: str = None, endDate: str = None, localizationCumprob: float = 0.95, numberDetections: int = 2, numPerPage: int = 100, url: str = None, token: str = None, whitelisted: bool = False, directory: str = None, use_cache: bool = True, save_json: bool = False, reuse_results: bool = False):
     """
     Dump the data to yaml files.
     """
 
-    print("Fetching sources and photometry... Please wait")
+    # parameters the results depend on, saved to config_used.yaml once the dump is done
+    params = {
+        "localizationDateobs": localizationDateobs,
+        "localizationName": localizationName,
+        "startDate": startDate,
+        "endDate": endDate,
+        "localizationCumprob": localizationCumprob,
+        "numberDetections": numberDetections,
+        "url": url,
+        "token": token,
+    }
+    params = {k: v for k, v in params.items() if v is not None}
+    results_files = ["data.yaml", "data.json"] if save_json else ["data.yaml"]
+    if reuse_results and reuse_previous_results(params, directory, results_files):
+        return
+
+    log.info("Fetching sources and photometry... Please wait")
     status, data = get_all_sources_and_phot(localizationDateobs, localizationName, startDate, endDate, localizationCumprob, numberDetections, numPerPage, url, token, whitelisted)
     status = 200
     if status == 200 or status == 500:
-        print("Found {} sources".format(len(data)))
-        print("Formatting photometry...")
+        log.info("Found {} sources".format(len(data)))
+        log.info("Formatting photometry...")
         sources, photometry_ref, instrument_ids = seperate_sources_from_phot(data, directory)
         
-        print("Fetching groups, instruments and telescopes from Skyportal...")
+        log.info("Fetching groups, instruments and telescopes from Skyportal...")
         
-        status, instruments = get_instruments_from_ids(instrument_ids, url, token)
-        telescope_ids = list(set([instrument['telescope_id'] for instrument in instruments]))
-        status, telescopes = get_telescopes_from_ids(telescope_ids, url, token)
+        status, instruments, telescopes = cached_get(
+            ("instruments_and_telescopes", url, token, sorted(instrument_ids)),
+            lambda: get_instruments_and_telescopes_from_ids(instrument_ids, url, token, whitelisted),
+            ttl=24 * 3600 if use_cache else 0, valid=lambda result: result[0] == 200,
+        )
+        if status != 200:
+            log.error("Error getting instruments and telescopes")
+            return
 
-        print("Fetching gcn notice from Skyportal...")
-        status, tags, notice = get_gcnevent_data(localizationDateobs, localizationName, url, token)
+        log.info("Fetching gcn notice from Skyportal...")
+        # new notices can be added to an event, so it is only cached for an hour
+        status, tags, notice = cached_get(
+            ("gcnevent_data", url, token, localizationDateobs, localizationName),
+            lambda: get_gcnevent_data(localizationDateobs, localizationName, url, token),
+            ttl=3600 if use_cache else 0, valid=lambda result: result[0] == 200,
+        )
         if status != 200:
-            print("Error getting gcn data")
+            log.error("Error getting gcn data")
             return
         gcn_event = {}
         if notice is None:
-            skymap_data = get_skymap(localizationDateobs, localizationName, url, token)
-            if skymap_data is None:
-                print("Error getting skymap")
+            # a named skymap never changes
+            skymap_data = cached_get(
+                ("skymap", url, token, localizationDateobs, localizationName),
+                lambda: get_skymap(localizationDateobs, localizationName, url, token),
+                ttl=None if use_cache else 0, valid=lambda result: len(result) > 0,
+            )
+            if len(skymap_data) == 0:
+                log.error("Error getting skymap")
                 return
-            filename = f'{directory}/{localizationName}.fits'
-            hp.fitsfunc.write_map(filename, skymap_data, overwrite=True, nest=False, column_names=['PROB']) # column_names=['UNIQ', 'PROBDENSITY', 'DISTMU', 'DISTSIGMA', 'DISTNORM']
-            gcn_event = {'dateobs': localizationDateobs, 'skymap': os.path.abspath(filename), 'tags': tags}
+            filename = os.path.abspath(f'{directory}/{localizationName}.fits')
+            # imported here so that --help and the dumps of notices don't pay for healpy's import
+            import healpy as hp
+            # probabilities don't need double precision, single halves the size of the file
+            hp.fitsfunc.write_map(filename, skymap_data, overwrite=True, nest=False, column_names=['PROB'], dtype='float32') # column_names=['UNIQ', 'PROBDENSITY', 'DISTMU', 'DISTSIGMA', 'DISTNORM']
+            gcn_event = {'dateobs': localizationDateobs, 'skymap': filename, 'tags': tags}
         else:
             # save the notice to a file
-            filename = f'{directory}/{localizationName}.txt'
+            filename = os.path.abspath(f'{directory}/{localizationName}.txt')
             with open(filename, 'w') as f:
                 f.write(notice)
-            gcn_event = {'xml': os.path.abspath(filename)}
+            gcn_event = {'xml': filename}
 
         
-        print("Formatting sources, instruments and telescopes...")
-
-        new_telescopes = []
-        telescope_yaml_ids = {}
-        for telescope in telescopes:
-            formatted_telescope = formattedTelescope(telescope)
-            new_telescopes.append(formatted_telescope)
-            telescope_yaml_ids[telescope["id"]] = formatted_telescope["=id"]
+        log.info("Formatting sources, instruments and telescopes...")
+
+        # the same telescope or instrument can be returned more than once, only format and dump each of them once
+        telescopes = list({telescope["id"]: telescope for telescope in telescopes}.values())
+        instruments = list({instrument["id"]: instrument for instrument in instruments}.values())
+
+        new_telescopes = [formattedTelescope(telescope) for telescope in telescopes]
+        telescope_yaml_ids = {telescope["id"]: new_telescope["=id"] for telescope, new_telescope in zip(telescopes, new_telescopes)}
         telescopes = new_telescopes
-            
-        new_instruments = []
-        instrument_yaml_ids = {}
-        for instrument in instruments:
-            formatted_instrument = formattedInstrument(instrument, telescope_yaml_ids)
-            new_instruments.append(formatted_instrument)
-            instrument_yaml_ids[instrument["id"]] = formatted_instrument["=id"]
+
+        new_instruments = [formattedInstrument(instrument, telescope_yaml_ids) for instrument in instruments]
+        instrument_yaml_ids = {instrument["id"]: new_instrument["=id"] for instrument, new_instrument in zip(instruments, new_instruments)}
         instruments = new_instruments
 
-        sources = [formattedSource(source) for source in sources]
         photometry_ref = [formattedPhotRef(phot_ref, instrument_yaml_ids) for phot_ref in photometry_ref]
 
         data_to_yaml = {
@@ -72,21 +101,15 @@ def dump(localizationDateobs: str = None, localizationName: str = None, startDat
             "gcn_event": [gcn_event]
         }
 
-        print(f"Saving data to '{directory}/data.yaml'")
+        log.info(f"Saving data to '{directory}/data.yaml'")
         dict_to_yaml(data_to_yaml, f"{directory}/data.yaml")
+        if save_json:
+            log.info(f"Saving data to '{directory}/data.json'")
+            dict_to_json(data_to_yaml, f"{directory}/data.json")
 
-        params = {
-            "localizationDateobs": localizationDateobs,
-            "localizationName": localizationName,
-            "startDate": startDate,
-            "endDate": endDate,
-            "numPerPage": numPerPage,
-            "url": url,
-            "token": token
-
-        }
         dict_to_yaml(params, f"{directory}/config_used.yaml")
-        print("Done! Now, you can load the results in a Skyportal instance.")
+        save_results_index(params, directory)
+        log.info("Done! Now, you can load the results in a Skyportal instance.")
     
 def main():
     parser = argparse.ArgumentParser(description="Dump SkyPortal sources found in a GCN Event, and their photometry.")
@@ -101,8 +124,13 @@ def main():
     parser.add_argument("--token", help="The token of the Skyportal instance.", type=str)
     parser.add_argument("--whitelisted", help="IP whitelisted on SkyPortal, no api calls limitation.", action="store_true")
     parser.add_argument("--use_config", help="Use config file to get parameters. Use it if you want to use the config file rather than providing parameters in the command line.", action="store_true")
+    parser.add_argument("--verbose", help="Show the progress of the dump.", action="store_true")
     parser.add_argument("--directory", help="Directory to save results to. If not provided, a random directory name in results/ will be used.", type=str)
+    parser.add_argument("--json", help="Also save the data to a data.json file, next to data.yaml.", action="store_true")
+    parser.add_argument("--reuse_results", help="If a previous dump was done with the same parameters in the last 24 hours, copy its results instead of fetching everything again.", action="store_true")
+    parser.add_argument("--no_cache", help="Don't reuse the gcn event, skymap, instruments and telescopes cached by previous runs.", action="store_true")
     args = parser.parse_args()
+    setup_logging(args.verbose)
 
     use_config = args.use_config
     if use_config is True:
@@ -119,7 +147,7 @@ def main():
             url = config["skyportal_url"]
             token = config["skyportal_token"]
         except KeyError as e:
-            print("Error: {} not found in config file.".format(e))
+            log.error("Error: {} not found in config file.".format(e))
             return
     else:
         localizationDateobs = args.localizationDateobs
@@ -152,29 +180,12 @@ def main():
         missing_params.append("token")
 
     if len(missing_params) > 0:
-        print("Error: the following parameters are missing: {}".format(', '.join(missing_params)))
+        log.error("Error: the following parameters are missing: {}".format(', '.join(missing_params)))
         return
 
-    if args.directory is None:
-        directory = f"results/{localizationDateobs}"
-        counter = 1
-        while os.path.exists(directory):
-            directory = f"results/{localizationDateobs}_{counter}"
-            counter += 1
-        if not os.path.exists("results"):
-            os.makedirs("results")
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-    else:
-        directory = args.directory
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-    if not os.path.exists("{}/photometry".format(directory)):
-        os.makedirs("{}/photometry".format(directory))
+    directory = make_results_directory(localizationDateobs, args.directory)
     
-    dump(localizationDateobs, localizationName, startDate, endDate, localizationCumprob, numberDetections, numPerPage, url, token, whitelisted, directory)
+    dump(localizationDateobs, localizationName, startDate, endDate, localizationCumprob, numberDetections, numPerPage, url, token, whitelisted, directory, not args.no_cache, args.json, args.reuse_results)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -3,21 +3,21 @@ from utils import *
 def dump(instrumentId=None, startDate=None, endDate=None, numPerPage=None, url=None, token=None, whitelisted=None, directory=None):
 
     if instrumentId is not None:
-        print(f"Fetching follow-up requests schedule for instrument_id: {instrumentId}... Please wait")
+        log.info(f"Fetching follow-up requests schedule for instrument_id: {instrumentId}... Please wait")
     else:
-        print(f"Fetching follow-up requests... Please wait")
-    status, followups, totalMatches = get_all_followup_requests(instrument_id=instrumentId, startDate=startDate, endDate=endDate, url=url, token=token)
+        log.info(f"Fetching follow-up requests... Please wait")
+    status, followups, totalMatches = get_all_followup_requests(instrument_id=instrumentId, startDate=startDate, endDate=endDate, url=url, token=token, whitelisted=whitelisted, numPerPage=numPerPage)
+    if status != 200:
+        log.error("Error getting follow-up requests")
+        return
 
-    objs = []
+    # several requests can be for the same source, it is only dumped once
+    objs = {}
     for followup in followups:
-        if not any(obj["id"] == followup["obj_id"] for obj in objs):
-            objs.append(followup['obj'])
-    sources = [formattedSource(obj) for obj in objs]
+        objs.setdefault(followup["obj_id"], followup['obj'])
+    sources = [formattedSource(obj) for obj in objs.values()]
 
-    followups = [formattedFollowupRequest(followups[i], i) for i in range(len(followups))]
-    if status != 200:
-        print("Error getting follow-up requests")
-        return
+    followups = [formattedFollowupRequest(followup, i) for i, followup in enumerate(followups)]
     
     data_to_yaml = {
     "groups": [public_group],
@@ -27,7 +27,7 @@ def dump(instrumentId=None, startDate=None, endDate=None, numPerPage=None, url=N
 
     }
 
-    print(f"Saving data to '{directory}/data.yaml'")
+    log.info(f"Saving data to '{directory}/data.yaml'")
     dict_to_yaml(data_to_yaml, f"{directory}/data.yaml")
     
 
@@ -36,13 +36,15 @@ def main():
     parser.add_argument("--instrumentId", help="The id of the instrument for which we are getting follow-up requests", type=int)
     parser.add_argument("--startDate", help="First detection of the source after this date.", type=str)
     parser.add_argument("--endDate", help="Last detection of the source before this date.", type=str)
-    parser.add_argument("--numPerPage", help="Number of sources to query at once. Default is 100.", type=int, default=100)
+    parser.add_argument("--numPerPage", help="Number of follow-up requests to query at once. Default is 100.", type=int, default=100)
     parser.add_argument("--url", help="The url of the Skyportal instance.", type=str)
     parser.add_argument("--token", help="The token of the Skyportal instance.", type=str)
     parser.add_argument("--whitelisted", help="IP whitelisted on SkyPortal, no api calls limitation.", action="store_true")
     parser.add_argument("--use_config", help="Use config file to get parameters. Use it if you want to use the config file rather than providing parameters in the command line.", action="store_true")
+    parser.add_argument("--verbose", help="Show the progress of the dump.", action="store_true")
     parser.add_argument("--directory", help="Directory to save results to. If not provided, a random directory name in results/ will be used.", type=str)
     args = parser.parse_args()
+    setup_logging(args.verbose)
 
     use_config = args.use_config
     if use_config is True:
@@ -59,7 +61,7 @@ def main():
             token = config["skyportal_token"]
             whitelisted = config["whitelisted"]
         except KeyError as e:
-            print("Error: {} not found in config file.".format(e))
+            log.error("Error: {} not found in config file.".format(e))
             return
     else:
         instrumentId = args.instrumentId
@@ -77,24 +79,10 @@ def main():
         missing_params.append("token")
 
     if len(missing_params) > 0:
-        print("Error: the following parameters are missing: {}".format(', '.join(missing_params)))
+        log.error("Error: the following parameters are missing: {}".format(', '.join(missing_params)))
         return
 
-    dir = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-    if args.directory is None:
-        directory = f"results/{dir}"
-        counter = 1
-        while os.path.exists(directory):
-            directory = f"results/{dir}_{counter}"
-            counter += 1
-        if not os.path.exists("results"):
-            os.makedirs("results")
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-    else:
-        directory = args.directory
-        if not os.path.exists(directory):
-            os.makedirs(directory)
+    directory = make_results_directory(datetime.now().strftime('%Y-%m-%d_%H-%M-%S'), args.directory)
     
     dump(instrumentId, startDate, endDate, numPerPage, url, token, whitelisted, directory)
 
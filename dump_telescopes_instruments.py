@@ -1,63 +1,57 @@
 from utils import *
 
-def dump(url: str = None, token: str = None, whitelisted: bool = False, directory: str = None):
+def dump(url: str = None, token: str = None, whitelisted: bool = False, directory: str = None, use_cache: bool = True):
     """
     Dump the data to yaml files.
     """
 
-    print("Fetching telescopes and instruments... Please wait")
+    log.info("Fetching telescopes and instruments... Please wait")
     status = 200
     if status == 200 or status == 500:
         
-        print("instruments and telescopes from Skyportal...")
+        log.info("instruments and telescopes from Skyportal...")
         
-        status, instruments = get_instruments(url, token)
+        # the catalogs rarely change, a rerun on the same day reuses them
+        status, instruments = cached_get(
+            ("instruments", url, token), lambda: get_instruments(url, token),
+            ttl=24 * 3600 if use_cache else 0, valid=lambda result: result[0] == 200,
+        )
 
-        status, telescopes = get_telescopes(url, token)
+        status, telescopes = cached_get(
+            ("telescopes", url, token), lambda: get_telescopes(url, token),
+            ttl=24 * 3600 if use_cache else 0, valid=lambda result: result[0] == 200,
+        )
 
         all_allocations = []
 
-        new_telescopes = []
+        # first remove duplicates (i.e telescopes with the same id), then format them in place
+        telescopes = list({telescope["id"]: telescope for telescope in telescopes}.values())
         telescope_yaml_ids = {}
+        for i, telescope in enumerate(telescopes):
+            telescopes[i] = formattedTelescope(telescope)
+            telescope_yaml_ids[telescope["id"]] = telescopes[i]["=id"]
 
-        # first remove duplicates (i.e telescopes with the same id)
-        temp_telescopes = []
-        for telescope in telescopes:
-            if not any(t["id"] == telescope["id"] for t in temp_telescopes):
-                temp_telescopes.append(telescope)
-        telescopes = temp_telescopes
-
-        for telescope in telescopes:
-            formatted_telescope = formattedTelescope(telescope)
-            new_telescopes.append(formatted_telescope)
-            telescope_yaml_ids[telescope["id"]] = formatted_telescope["=id"]
-        telescopes = new_telescopes
-            
-        new_instruments = []
-        instrument_yaml_ids = {}
+        # same for the instruments
+        instruments = list({instrument["id"]: instrument for instrument in instruments}.values())
+        log.info("Fetching allocations... Please wait")
 
-        # first remove duplicates (i.e instruments with the same id)
-        temp_instruments = []
-        for instrument in instruments:
-            if not any(i["id"] == instrument["id"] for i in temp_instruments):
-                temp_instruments.append(instrument)
-        instruments = temp_instruments
-
-        for i in range(len(instruments)):
-            instrument = instruments[i]
-            formatted_instrument = formattedInstrument(instrument, telescope_yaml_ids)
-            new_instruments.append(formatted_instrument)
-            instrument_yaml_ids[instrument["id"]] = formatted_instrument["=id"]
-            status, allocations = get_allocations(instrument['id'], url, token)
-            if status == 200:
-                all_allocations.extend(allocations)
-            if not whitelisted and i % 10 == 0:
-                print("Fetching allocations... Please wait")
-                time.sleep(1)
+        def get_instrument_allocations(instrument):
+            if not whitelisted:
+                rate_limiter.wait()
+            return get_allocations(instrument['id'], url, token)
 
-        all_allocations = [formattedAllocation(allocation, instrument_yaml_ids) for allocation in all_allocations]
+        # the allocations of several instruments are fetched at once, the rate limiter still spaces the calls if needed
+        with ThreadPoolExecutor(max_workers=8 if whitelisted else 4) as executor:
+            for status, allocations in executor.map(get_instrument_allocations, instruments):
+                if status == 200:
+                    all_allocations.extend(allocations)
+
+        instrument_yaml_ids = {}
+        for i, instrument in enumerate(instruments):
+            instruments[i] = formattedInstrument(instrument, telescope_yaml_ids)
+            instrument_yaml_ids[instrument["id"]] = instruments[i]["=id"]
 
-        instruments = new_instruments
+        all_allocations = [formattedAllocation(allocation, instrument_yaml_ids) for allocation in all_allocations]
 
         data_to_yaml = {
             "groups": [public_group],
@@ -67,10 +61,10 @@ def dump(url: str = None, token: str = None, whitelisted: bool = False, director
             "allocation": all_allocations
         }
 
-        print(f"Saving data to '{directory}/data.yaml'")
+        log.info(f"Saving data to '{directory}/data.yaml'")
         dict_to_yaml(data_to_yaml, f"{directory}/data.yaml")
 
-        print("Done! Now, you can load the results in a Skyportal instance.")
+        log.info("Done! Now, you can load the results in a Skyportal instance.")
     
 def main():
     parser = argparse.ArgumentParser(description="Dump SkyPortal telescopes and their instruments.")
@@ -78,8 +72,11 @@ def main():
     parser.add_argument("--token", help="The token of the Skyportal instance.", type=str)
     parser.add_argument("--whitelisted", help="IP whitelisted on SkyPortal, no api calls limitation.", action="store_true")
     parser.add_argument("--use_config", help="Use config file to get parameters. Use it if you want to use the config file rather than providing parameters in the command line.", action="store_true")
+    parser.add_argument("--verbose", help="Show the progress of the dump.", action="store_true")
     parser.add_argument("--directory", help="Directory to save results to. If not provided, a random directory name in results/ will be used.", type=str)
+    parser.add_argument("--no_cache", help="Don't reuse the instruments and telescopes cached by previous runs.", action="store_true")
     args = parser.parse_args()
+    setup_logging(args.verbose)
 
     use_config = args.use_config
     if use_config is True:
@@ -89,7 +86,7 @@ def main():
             url = config["skyportal_url"]
             token = config["skyportal_token"]
         except KeyError as e:
-            print("Error: {} not found in config file.".format(e))
+            log.error("Error: {} not found in config file.".format(e))
             return
     else:
         whitelisted = args.whitelisted
@@ -103,26 +100,12 @@ def main():
         missing_params.append("token")
 
     if len(missing_params) > 0:
-        print("Error: the following parameters are missing: {}".format(', '.join(missing_params)))
+        log.error("Error: the following parameters are missing: {}".format(', '.join(missing_params)))
         return
 
-    dir = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-    if args.directory is None:
-        directory = f"results/{dir}"
-        counter = 1
-        while os.path.exists(directory):
-            directory = f"results/{dir}_{counter}"
-            counter += 1
-        if not os.path.exists("results"):
-            os.makedirs("results")
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-    else:
-        directory = args.directory
-        if not os.path.exists(directory):
-            os.makedirs(directory)
+    directory = make_results_directory(datetime.now().strftime('%Y-%m-%d_%H-%M-%S'), args.directory)
     
-    dump(url, token, whitelisted, directory)
+    dump(url, token, whitelisted, directory, not args.no_cache)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
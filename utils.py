@@ -1,16 +1,25 @@
 import os
 import time
+import threading
 import uuid
 import csv
 import yaml
 import requests
+from urllib3.util.retry import Retry
 import argparse
-import numpy as np
-import healpy as hp
+import logging
 import re
-from datetime import datetime
-import pandas as pd
+import xml.etree.ElementTree as ElementTree
+from datetime import datetime, date
 import io
+import json
+import functools
+import operator
+import hashlib
+import pickle
+import shutil
+import base64
+from concurrent.futures import ThreadPoolExecutor
 
 group_fields = ['name']
 telescope_fields = ['name', 'nickname', 'lat', 'lon', 'elevation', 'diameter', 'robotic', 'fixed_location', 'skycam_link', 'weather_link']
@@ -32,12 +41,169 @@ public_user = {
     "group_ids": ["=public_group_id"],
 }
 
-class MyDumper(yaml.SafeDumper):
-    def write_line_break(self, data=None):
-        super().write_line_break(data)
+log = logging.getLogger("skyportal_dumps")
+log.addHandler(logging.NullHandler())
 
-        if len(self.indents) == 1 or len(self.indents) == 2:
-            super().write_line_break()
+def setup_logging(verbose: bool = False):
+    """
+    Show the progress messages of the dumps if verbose, otherwise only the warnings and errors.
+    """
+    logging.basicConfig(level=logging.INFO if verbose else logging.WARNING, format="%(message)s")
+
+try:
+    # libyaml bindings, much faster than the pure-python emitter
+    from yaml import CSafeDumper as SafeDumper, CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeDumper, SafeLoader
+
+try:
+    # optional, much faster than the json module
+    import orjson
+except ImportError:
+    orjson = None
+
+def add_blank_lines(text):
+    """
+    Add an empty line before every top-level key and top-level list item,
+    to keep the dumps readable.
+    """
+    lines = text.splitlines(keepends=True)
+    for i in range(1, len(lines)):
+        if lines[i][0] not in " \n":
+            lines[i] = "\n" + lines[i]
+    return "".join(lines)
+
+_yaml_resolver = yaml.resolver.Resolver()
+_plain_str_regex = re.compile(r"[\w=./()+][\w=./()+:,;@ -]*", re.ASCII)
+_non_printable_regex = re.compile(r"[^\x20-\x7e]")
+
+def _escape_non_printable(match):
+    code = ord(match.group(0))
+    return f"\\u{code:04x}" if code <= 0xFFFF else f"\\U{code:08x}"
+
+@functools.lru_cache(maxsize=4096)
+def _yaml_str(value):
+    # plain if it can't be confused with another type or a yaml indicator
+    if (
+        _plain_str_regex.fullmatch(value)
+        and ": " not in value
+        and not value.endswith((" ", ":"))
+        and _yaml_resolver.resolve(yaml.ScalarNode, value, (True, False)) == "tag:yaml.org,2002:str"
+    ):
+        return value
+    if value and not _non_printable_regex.search(value):
+        return "'" + value.replace("'", "''") + "'"
+    # json escapes are valid in yaml double-quoted scalars
+    return _non_printable_regex.sub(_escape_non_printable, json.dumps(value, ensure_ascii=False))
+
+def _yaml_scalar(value):
+    if value is None:
+        return "null"
+    if isinstance(value, str):
+        return _yaml_str(value)
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, float):
+        if value != value:
+            return ".nan"
+        if value in (float("inf"), float("-inf")):
+            return ".inf" if value > 0 else "-.inf"
+        text = repr(value).lower()
+        if "." not in text and "e" in text:
+            text = text.replace("e", ".0e", 1)
+        return text
+    if isinstance(value, datetime):
+        return value.isoformat(" ")
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        return "!!binary " + (base64.b64encode(value).decode("ascii") or "''")
+    raise yaml.representer.RepresenterError("cannot represent an object", value)
+
+def _yaml_value_after_key(value, indent, write):
+    if isinstance(value, dict) and value:
+        write(":\n")
+        _yaml_mapping(value, indent + 2, " " * (indent + 2), write)
+    elif isinstance(value, list) and value:
+        write(":\n")
+        _yaml_sequence(value, indent, " " * indent, write)
+    elif isinstance(value, set) and value:
+        # like SafeDumper, a set is a mapping of its items to null
+        write(": !!set\n")
+        _yaml_mapping(dict.fromkeys(value), indent + 2, " " * (indent + 2), write)
+    else:
+        write(": " + _yaml_block_or_inline(value) + "\n")
+
+def _yaml_block_or_inline(value):
+    if isinstance(value, dict):
+        return "{}"
+    if isinstance(value, list):
+        return "[]"
+    if isinstance(value, set):
+        return "!!set {}"
+    return _yaml_scalar(value)
+
+def _yaml_mapping(data, indent, prefix, write):
+    pad = " " * indent
+    for i, (key, value) in enumerate(data.items()):
+        write((prefix if i == 0 else pad) + _yaml_scalar(key))
+        _yaml_value_after_key(value, indent, write)
+
+def _yaml_sequence(data, indent, prefix, write):
+    pad = " " * indent
+    for i, item in enumerate(data):
+        write((prefix if i == 0 else pad) + "- ")
+        if isinstance(item, dict) and item:
+            _yaml_mapping(item, indent + 2, "", write)
+        elif isinstance(item, list) and item:
+            _yaml_sequence(item, indent + 2, "", write)
+        elif isinstance(item, set) and item:
+            write("!!set\n")
+            _yaml_mapping(dict.fromkeys(item), indent + 2, " " * (indent + 2), write)
+        else:
+            write(_yaml_block_or_inline(item) + "\n")
+
+# below this many entries, libyaml is fast enough and the output is the reference one
+fast_yaml_dump_min_entries = 1000
+
+def fast_yaml_dump(data, stream):
+    """
+    Write a dictionary to a stream as block-style yaml, without going through PyYAML.
+    Only dicts, lists, sets, strings, bytes, numbers, booleans, dates, datetimes and None are supported,
+    and no anchors/aliases are emitted. Like dict_to_yaml, top-level keys and
+    top-level list items are separated by an empty line.
+
+    Arguments
+    ----------
+        data : dict
+            dictionary to write
+        stream : file
+            stream to write the yaml to
+
+    Returns
+    ----------
+        None
+    """
+    chunks = []
+    write = chunks.append
+    for i, (key, value) in enumerate(data.items()):
+        if i > 0:
+            write("\n")
+        write(_yaml_scalar(key))
+        if isinstance(value, list) and value:
+            write(":\n")
+            for item in value:
+                write("\n")
+                _yaml_sequence([item], 0, "", write)
+                # flush regularly so that the whole document is never held in memory as one string
+                if len(chunks) >= 4096:
+                    stream.write("".join(chunks))
+                    chunks.clear()
+        else:
+            _yaml_value_after_key(value, 0, write)
+    stream.write("".join(chunks))
 
 def yaml_to_dict(file_path):
     """
@@ -56,7 +222,7 @@ def yaml_to_dict(file_path):
 
     with open(file_path, "r") as stream:
         try:
-            conf = yaml.safe_load(stream)
+            conf = yaml.load(stream, Loader=SafeLoader)
         except yaml.YAMLError as exc:
             raise exc
     return conf
@@ -83,7 +249,7 @@ def dict_to_yaml(dict, file_path):
         data = yaml_to_dict(file_path)
 
         for k, v in data.items():
-            print(k)
+            log.debug(k)
             if k not in dict:
                 dict[k] = v
             else:
@@ -92,19 +258,281 @@ def dict_to_yaml(dict, file_path):
                         [value for value in v if not any([value['=id'] == value2['=id'] if '=id' in value2 else value['id'] == value2['id'] for value2 in dict[k]])]
                         )
 
-    # reorder the keys using a defined order
+    # reorder the keys using a defined order, keys that are not part of it are kept after them
     order = ['groups', 'user', 'telescope', 'instrument', 'sources', 'photometry', 'allocation', 'followup_request', 'gcn_event']
-    dict = {k: dict[k] for k in order if k in dict}
+    dict = {**{k: dict[k] for k in order if k in dict}, **{k: v for k, v in dict.items() if k not in order}}
 
     with open(
         file_path,
         "w",
     ) as stream:
         try:
-            yaml.dump(dict, stream, Dumper=MyDumper, sort_keys=False, default_flow_style=False)
+            if sum(len(v) for v in dict.values() if isinstance(v, list)) > fast_yaml_dump_min_entries:
+                # large dumps: skip PyYAML's representers entirely
+                fast_yaml_dump(dict, stream)
+            elif len(dict) == 0:
+                stream.write(yaml.dump(dict, Dumper=SafeDumper))
+            else:
+                # one top-level key at a time, so that only one section's text is held in memory
+                for i, (k, v) in enumerate(dict.items()):
+                    if i > 0:
+                        stream.write("\n")
+                    stream.write(add_blank_lines(yaml.dump({k: v}, Dumper=SafeDumper, sort_keys=False, default_flow_style=False)))
         except yaml.YAMLError as exc:
             raise exc
 
+def dict_to_json(dict, file_path):
+    """
+    Write a dictionary to a json file.
+
+    Arguments
+    ----------
+        dict : dict
+            dictionary to write to the json file
+        file_path : str
+            path to the json file
+
+    Returns
+    ----------
+        None
+    """
+    if orjson is not None:
+        with open(file_path, "wb") as stream:
+            stream.write(orjson.dumps(dict, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
+    else:
+        with open(file_path, "w") as stream:
+            json.dump(dict, stream, indent=2)
+
+def make_results_directory(name: str, directory: str = None):
+    """
+    Create the directory to save the results to.
+
+    Arguments
+    ----------
+        name : str
+            name of the directory to create in results/ if no directory is provided.
+            If it is already taken, a counter is appended to it (name_1, name_2, ...)
+        directory : str
+            directory provided by the user, created if it doesn't exist
+
+    Returns
+    ----------
+        directory : str
+            path to the directory
+    """
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    os.makedirs("results", exist_ok=True)
+    # list results/ once to find the first free name, rather than checking each candidate
+    with os.scandir("results") as entries:
+        existing = {entry.name for entry in entries}
+    candidate = name
+    counter = 1
+    while True:
+        while candidate in existing:
+            candidate = f"{name}_{counter}"
+            counter += 1
+        # mkdir fails if the directory exists, so two runs started at the same time can't get the same one
+        try:
+            os.mkdir(f"results/{candidate}")
+            return f"results/{candidate}"
+        except FileExistsError:
+            existing.add(candidate)
+
+def _results_index_path(query: dict, directory: str):
+    # the index is kept next to the results directories, e.g. results/.index for results/<name>.
+    # The token is part of the query (it decides what can be seen), so only a hash of it ends up on disk
+    index_directory = os.path.join(os.path.dirname(os.path.abspath(directory)), ".index")
+    return os.path.join(index_directory, hashlib.sha256(repr(sorted(query.items())).encode()).hexdigest()[:16])
+
+def reuse_previous_results(query: dict, directory: str, files: list = ["data.yaml"], max_age: float = 24 * 3600):
+    """
+    Copy the results of a previous dump done with the same query to a directory.
+
+    Arguments
+    ----------
+        query : dict
+            parameters that the results depend on
+        directory : str
+            directory to copy the results to
+        files : list
+            files that the previous results must contain to be reused
+        max_age : float
+            number of seconds after which previous results are considered outdated, as sources and photometry keep being added
+
+    Returns
+    ----------
+        reused : bool
+            True if previous results were found and copied
+    """
+    index_path = _results_index_path(query, directory)
+    try:
+        if time.time() - os.path.getmtime(index_path) > max_age:
+            return False
+        with open(index_path) as f:
+            previous_directory = f.read().strip()
+    except OSError:
+        return False
+    directory = os.path.abspath(directory)
+    if previous_directory == directory or not all(os.path.exists(os.path.join(previous_directory, file)) for file in files):
+        return False
+
+    shutil.copytree(previous_directory, directory, dirs_exist_ok=True)
+    # the skymap/notice are referenced with absolute paths, point them to the copies.
+    # The previous dump may have written more result files than the ones required here, e.g. data.json
+    for file in ("data.yaml", "data.json"):
+        path = os.path.join(directory, file)
+        if not os.path.exists(path):
+            continue
+        if file.endswith(".json"):
+            with open(path) as f:
+                data = json.load(f)
+        else:
+            data = yaml_to_dict(path)
+        for gcn_event in data.get("gcn_event") or []:
+            for key in ("skymap", "xml"):
+                value = gcn_event.get(key)
+                if isinstance(value, str) and value.startswith(previous_directory + os.sep):
+                    gcn_event[key] = os.path.join(directory, os.path.relpath(value, previous_directory))
+        if file.endswith(".json"):
+            dict_to_json(data, path)
+        else:
+            # dict_to_yaml merges into an existing file, start from an empty one
+            os.remove(path)
+            dict_to_yaml(data, path)
+    log.info(f"Reused the results of a previous dump with the same parameters, from '{previous_directory}'")
+    return True
+
+def save_results_index(query: dict, directory: str):
+    """
+    Remember the directory holding the results of a dump, so that it can be reused by reuse_previous_results.
+    """
+    index_path = _results_index_path(query, directory)
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    with open(index_path, "w") as f:
+        f.write(os.path.abspath(directory))
+
+cache_directory = os.path.join(os.path.expanduser("~"), ".cache", "skyportal-dumps")
+
+def cached_get(key, fetcher, ttl: float = None, valid=None):
+    """
+    Return the result of fetcher(), cached on disk so that reruns don't fetch it again.
+
+    Arguments
+    ----------
+        key : tuple
+            Identifies the request (e.g. endpoint and parameters). Hashed, so it can contain the token.
+        fetcher : callable
+            Function to call when there is no usable cached result
+        ttl : float
+            Number of seconds a cached result stays valid. None means it never expires.
+        valid : callable
+            Called with the result, returns whether it can be cached. By default everything is cached.
+
+    Returns
+    ----------
+        result : any
+            Result of fetcher(), possibly from the cache
+    """
+    path = os.path.join(cache_directory, hashlib.sha256(repr(key).encode()).hexdigest() + ".pkl")
+    try:
+        if ttl is None or time.time() - os.path.getmtime(path) < ttl:
+            with open(path, "rb") as f:
+                return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+
+    result = fetcher()
+    if valid is None or valid(result):
+        os.makedirs(cache_directory, exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+    return result
+
+def memoize(ttl: float = 300):
+    """
+    Keep the successful results of an api getter in memory for ttl seconds,
+    so that a catalog fetched several times in a run is only downloaded once.
+    Only results with a 200 status are kept. The cached lists are shared, callers must not modify them.
+
+    Arguments
+    ----------
+        ttl : float
+            number of seconds a result is reused for
+
+    Returns
+    ----------
+        decorator : function
+            decorator to apply to a function returning (status_code, data)
+    """
+    def decorator(func):
+        cache = {}
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            with lock:
+                cached = cache.get(key)
+            if cached is not None and time.monotonic() - cached[0] < ttl:
+                return cached[1]
+            result = func(*args, **kwargs)
+            if result[0] == 200:
+                with lock:
+                    cache[key] = (time.monotonic(), result)
+            return result
+
+        wrapper.cache_clear = cache.clear
+        return wrapper
+    return decorator
+
+# retry the idempotent requests when skyportal is overloaded or restarting, the last response is returned if it keeps failing
+retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504], raise_on_status=False)
+session = requests.Session()
+session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=retries))
+session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=retries))
+session.headers["User-Agent"] = "skyportal-dumps"
+# (connect, read) timeouts in seconds, so that a stalled connection is retried rather than blocking the dump forever.
+# The read timeout is the time between two bytes, not the time to download the whole response
+request_timeout = (10, 120)
+
+class RateLimiter:
+    """
+    Space out calls evenly so that there are at most `rate` of them per second.
+    Thread-safe, so it can be shared by all the requests of a run.
+    """
+
+    def __init__(self, rate: float = 10):
+        self.interval = 1 / rate
+        self.next_allowed = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """
+        Block until the next call is allowed.
+        """
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_allowed - now
+            self.next_allowed = max(now, self.next_allowed) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+# used to stay under skyportal's api calls limitation when the IP isn't whitelisted
+rate_limiter = RateLimiter(10)
+
+@functools.lru_cache(maxsize=8)
+def auth_headers(token: str = None):
+    """
+    Headers authenticating the requests with a skyportal token, built once per token.
+    The token is only ever sent in this header, never in the url.
+    """
+    return {"Authorization": f"token {token}"}
+
 def api(
     method,
     endpoint,
@@ -123,6 +551,8 @@ def api(
             Endpoint to call
         data : dict
             Data to send with the request
+        params : dict
+            Query parameters, url-encoded by requests
         token : str
             Skyportal token
 
@@ -132,31 +562,69 @@ def api(
             Response from skyportal
 
     """
-    if params:
-        # add params in the url
-        endpoint += "?"
-        for key, value in params.items():
-            endpoint += f"{key}={value}&"
-        endpoint = endpoint[:-1]
-    
-    headers = {"Authorization": f"token {token}"}
-    response = requests.request(method, endpoint, json=data, headers=headers)
+    response = session.request(method, endpoint, json=data, params=params, headers=auth_headers(token), timeout=request_timeout)
     return response
 
+def response_json(response):
+    """
+    Parse the json body of a response, with orjson when it is installed.
+
+    Arguments
+    ----------
+        response : requests.Response
+            Response from skyportal
+
+    Returns
+    ----------
+        data : dict
+            Parsed body of the response
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(response.content)
+        except orjson.JSONDecodeError:
+            # e.g. NaN values, which orjson doesn't accept but the json module does
+            pass
+    return response.json()
+
+def response_data(response, default=None):
+    """
+    Get the status code and the data of a response, parsing the body only if the request succeeded.
+
+    Arguments
+    ----------
+        response : requests.Response
+            Response from skyportal
+        default : any
+            Data returned when the request failed
+
+    Returns
+    ----------
+        status_code : int
+            HTTP status code
+        data : any
+            The "data" field of the response, or default
+    """
+    if response.status_code != 200:
+        return response.status_code, default
+    return response.status_code, response_json(response)["data"]
+
 def formattedInstrument(instrument, telescope_yaml_ids: dict = None):
     """
     Keep only the fields that are needed.
     """
-    formatted_instrument = {}
-    for field in instrument_fields:
-        if field in instrument:
-            formatted_instrument[field] = instrument[field]
-        else:
-            formatted_instrument[field] = None
+    formatted_instrument = {field: instrument.get(field) for field in instrument_fields}
 
     formatted_instrument['=id'] = instrument['name'].strip()
-    if telescope_yaml_ids:
-        formatted_instrument['telescope_id'] = f"={telescope_yaml_ids[instrument['telescope_id']]}"
+    telescope_id = instrument.get('telescope_id')
+    if telescope_yaml_ids is not None:
+        if telescope_id in telescope_yaml_ids:
+            formatted_instrument['telescope_id'] = f"={telescope_yaml_ids[telescope_id]}"
+        else:
+            # the raw id would point to an unrelated telescope of the instance the dump is loaded into
+            if telescope_id is not None:
+                log.warning(f"Telescope {telescope_id} of instrument {formatted_instrument['=id']} was not found, its telescope_id is left empty")
+            formatted_instrument['telescope_id'] = None
     
     return formatted_instrument
 
@@ -164,12 +632,7 @@ def formattedTelescope(telescope):
     """
     Keep only the fields that are needed.
     """
-    formatted_telescope = {}
-    for field in telescope_fields:
-        if field in telescope:
-            formatted_telescope[field] = telescope[field]
-        else:
-            formatted_telescope[field] = None
+    formatted_telescope = {field: telescope.get(field) for field in telescope_fields}
 
     formatted_telescope['=id'] = telescope['nickname'].strip()
 
@@ -179,24 +642,17 @@ def formattedGroup(group):
     """
     Keep only the fields that are needed.
     """
-    formatted_group = {}
-    for field in group_fields:
-        if field in group:
-            formatted_group[field] = group[field]
-        else:
-            formatted_group[field] = None
+    formatted_group = {field: group.get(field) for field in group_fields}
 
     formatted_group['=id'] = group['name'].strip()
 
     return formatted_group
 
+@memoize()
 def get_all_analysis_services(url: str = None, token: str = None):
     analysis_services = api("GET", f"{url}/api/analysis_service", token=token)
 
-    data = []
-    if analysis_services.status_code == 200:
-        data = analysis_services.json()["data"]
-    return analysis_services.status_code, data
+    return response_data(analysis_services, [])
 
 def get_analysis_service(name: str = None, url: str = None, token: str = None):
     status, analysis_services = get_all_analysis_services(url=url, token=token)
@@ -210,10 +666,7 @@ def get_analysis_service(name: str = None, url: str = None, token: str = None):
 
 def get_analysis_from_source(source_id: str = None, url: str = None, token: str = None):
     analysis = api("GET", f"{url}/api/obj/analysis?objID={source_id}", token=token)
-    data = []
-    if analysis.status_code == 200:
-        data = analysis.json()["data"]
-    return analysis.status_code, data
+    return response_data(analysis, [])
 
 def start_nmma_analysis(source_id: str = None, analysis_service_id: int = None, url: str = None, token: str = None):
     params= {
@@ -231,54 +684,87 @@ def start_nmma_analysis(source_id: str = None, analysis_service_id: int = None,
 def get_gcnevent(localizationDateobs: str = None, url: str = None, token: str = None):
     gcn_event = api("GET", f"{url}/api/gcn_event/{localizationDateobs}", token=token)
 
-    data = {}
-    if gcn_event.status_code == 200:
-        data = gcn_event.json()["data"]
-    return gcn_event.status_code, data
+    return response_data(gcn_event, {})
+
+# localizations built from a position notice are named like ra_dec_radius (e.g. -0.5_0.5_0.5)
+_position_localization_regex = re.compile(r"^-?\d+\.?\d*_-?\d+\.?\d*_-?\d+\.?\d*$")
+# substrings rather than suffixes: skyportal names can carry a suffix, like bayestar.multiorder.fits,0
+skymap_extensions = ('.fit', '.fits', '.gz')
+
+def parse_notice(content: str):
+    """
+    Parse the VOEvent xml of a gcn notice.
+
+    Arguments
+    ----------
+        content : str
+            xml content of the notice
+
+    Returns
+    ----------
+        root : xml.etree.ElementTree.Element
+            root element of the notice, None if it isn't valid xml
+    """
+    try:
+        return ElementTree.fromstring(content)
+    except ElementTree.ParseError as e:
+        log.warning(f"Could not parse gcn notice: {e}")
+        return None
 
 def get_gcnevent_data(localizationDateobs: str = None, localizationName: str = None, url: str = None, token: str = None):
     status, gcn_event = get_gcnevent(localizationDateobs, url, token)
     if status != 200:
-        print(f"Error {status} when getting gcn_event for {localizationDateobs}")
+        log.error(f"Error {status} when getting gcn_event for {localizationDateobs}")
         return status, None, None
     localizationNames = [localization["localization_name"] for localization in gcn_event["localizations"]]
     if localizationName not in localizationNames:
-        print(f"{localizationName} not in {localizationNames}")
+        log.error(f"{localizationName} not in {localizationNames}")
         return 404, None, None
 
     notices = gcn_event['gcn_notices']
     # keep notices that have a "content" field
-    notices = [notice for notice in notices if "content" in notice]
+    notices = [notice for notice in notices if notice.get("content")]
     # check if the localization name is like: float_float_float (e.g. -0.5_0.5_0.5) using regex
-    if re.match(r"^-?\d+\.?\d*_-?\d+\.?\d*_-?\d+\.?\d*$", localizationName):
+    if _position_localization_regex.match(localizationName):
         ra, dec, radius = localizationName.split("_")
         # the localization is a fits file
-        position_notices = [notice for notice in notices if '<Position2D unit="deg">' in notice["content"]]
+        # lazily, so that the notices after the matching one are never scanned
+        position_notices = (notice for notice in notices if '<Position2D unit="deg">' in notice["content"])
         for notice in position_notices:
-            notice_ra = notice["content"].split('<C1>')[1].split('</C1>')[0]
-            notice_dec = notice["content"].split('<C2>')[1].split('</C2>')[0]
-            notice_radius = notice["content"].split('<Error2Radius>')[1].split('</Error2Radius>')[0]
-            if notice_ra in ra and notice_dec in dec and notice_radius in radius:
+            root = parse_notice(notice["content"])
+            if root is None:
+                continue
+            notice_ra = root.findtext(".//Position2D/Value2/C1", "").strip()
+            notice_dec = root.findtext(".//Position2D/Value2/C2", "").strip()
+            notice_radius = root.findtext(".//Position2D/Error2Radius", "").strip()
+            if notice_ra and notice_dec and notice_radius and notice_ra in ra and notice_dec in dec and notice_radius in radius:
                 return 200, gcn_event['tags'], notice["content"]
     # check if the localization name is a fits file
-    extensions = ['.fit', '.fits', '.gz']
-    if any(extension in localizationName for extension in extensions):
-        fits_notices = [notice for notice in notices if '<Param name="skymap_fits"' in notice["content"]]
+    if any(extension in localizationName for extension in skymap_extensions):
+        fits_notices = (notice for notice in notices if '<Param name="skymap_fits"' in notice["content"])
         for notice in fits_notices:
-            notice_file = notice["content"].split('<Param name="skymap_fits"')[1].split('</Param>')[0]
-            if localizationName in notice_file:
+            root = parse_notice(notice["content"])
+            if root is None:
+                continue
+            param = root.find(".//Param[@name='skymap_fits']")
+            if param is not None and localizationName in param.get("value", ""):
                 return 200, gcn_event['tags'], notice["content"]
 
     return 200, gcn_event['tags'], None
 
 def get_skymap(localizationDateobs: str = None, localizationName: str = None, url: str = None, token: str = None):
+    # imported here so that the scripts that never fetch a skymap don't pay for numpy's import
+    import numpy as np
+
     params = {"include2DMap": True}
     localization = api("GET", f"{url}/api/localization/{localizationDateobs}/name/{localizationName}", params=params, token=token)
     data = np.array([])
     if localization.status_code == 200:
-        data = np.array(localization.json()['data']["flat_2d"])
+        # with the dtype given, numpy converts the list in one pass instead of inferring the type first
+        data = np.array(response_json(localization)['data']["flat_2d"], dtype=np.float64)
     return data
 
+@memoize()
 def get_telescopes(url: str = None, token: str = None):
     """
     Get all telescopes from skyportal using its API
@@ -297,12 +783,66 @@ def get_telescopes(url: str = None, token: str = None):
             List of telescopes
     """
     telescopes = api("GET", f"{url}/api/telescope", token=token)
-    data = []
-    if telescopes.status_code == 200:
-        data = telescopes.json()["data"]
-    return telescopes.status_code, data
+    return response_data(telescopes, [])
 
-def get_telescopes_from_ids(telescope_ids: list = None, url: str = None, token: str = None):
+@memoize()
+def get_telescope(telescope_id: int = None, url: str = None, token: str = None):
+    """
+    Get a telescope from skyportal using its API
+
+    Arguments
+    ----------
+        telescope_id : int
+            Telescope id
+        url : str
+            Skyportal url
+        token : str
+            Skyportal token
+    Returns
+    ----------
+        status_code : int
+            HTTP status code
+        data : dict
+            Telescope
+    """
+    telescope = api("GET", f"{url}/api/telescope/{telescope_id}", token=token)
+    return response_data(telescope)
+
+def get_from_ids(get_one, ids: list = None, url: str = None, token: str = None, whitelisted: bool = False):
+    """
+    Get objects one by one from skyportal using its API, rather than downloading the whole catalog to keep a few of them.
+    The requests are sent concurrently. None ids are skipped.
+
+    Arguments
+    ----------
+        get_one : function
+            Function getting one object from its id, like get_telescope
+        ids : list
+            List of ids
+        url : str
+            Skyportal url
+        token : str
+            Skyportal token
+        whitelisted : bool
+            IP whitelisted on SkyPortal. If not, the requests are spaced by the rate limiter
+    Returns
+    ----------
+        status_code : int
+            HTTP status code, the first one that isn't 200 if any
+        data : list
+            List of the objects that were found, sorted by id
+    """
+    def get(id):
+        if whitelisted is False:
+            rate_limiter.wait()
+        return get_one(id, url, token)
+
+    with ThreadPoolExecutor(max_workers=8 if whitelisted is True else 4) as executor:
+        results = list(executor.map(get, sorted({id for id in ids if id is not None})))
+    status = next((status for status, _ in results if status != 200), 200)
+    return status, [data for status, data in results if status == 200]
+
+def get_telescopes_from_ids(telescope_ids: list = None, url: str = None, token: str = None, whitelisted: bool = False):
     """
     Get telescopes from skyportal using its API
 
@@ -314,6 +854,8 @@ def get_telescopes_from_ids(telescope_ids: list = None, url: str = None, token:
             Skyportal url
         token : str
             Skyportal token
+        whitelisted : bool
+            IP whitelisted on SkyPortal, no api calls limitation
     Returns
     ----------
         status_code : int
@@ -321,13 +863,41 @@ def get_telescopes_from_ids(telescope_ids: list = None, url: str = None, token:
         data : list
             List of telescopes
     """
-    status, all_telescopes = get_telescopes(url, token)
-    if status == 200:
-        telescopes = [telescope for telescope in all_telescopes if telescope['id'] in telescope_ids]
-    else:
-        telescopes = []
-    
-    return status, telescopes
+    return get_from_ids(get_telescope, telescope_ids, url, token, whitelisted)
+
+def get_all_pages(get_page, numPerPage: int = 100, batch_size: int = 8):
+    """
+    Get all the pages of a paginated endpoint, batch_size pages at a time.
+    The pages of a batch are fetched concurrently, until a page shorter than numPerPage shows that the last one was reached.
+    Only for whitelisted IPs, as it sends up to batch_size - 1 requests past the last page.
+
+    Arguments
+    ----------
+        get_page : function
+            Function getting a page from its page number, returning a status code and a list
+        numPerPage : int
+            Number of items per page
+        batch_size : int
+            Number of pages to fetch at once
+
+    Returns
+    ----------
+        status_code : int
+            HTTP status code of the last page used
+        data : list
+            Items of all the pages, in order
+    """
+    data = []
+    pageNumber = 1
+    with ThreadPoolExecutor(max_workers=batch_size) as executor:
+        while True:
+            for status_code, page in executor.map(get_page, range(pageNumber, pageNumber + batch_size)):
+                if status_code != 200:
+                    return status_code, data
+                data.extend(page)
+                if len(page) < numPerPage:
+                    return status_code, data
+            pageNumber += batch_size
 
 def get_all_observations(telescopeName: str = None, instrumentName: str = None, localizationDateobs: str = None, localizationName: str = None, startDate: str = None, endDate: str = None, localizationCumprob: float = 0.95, numPerPage: int = 1000, pageNumber: int = 1, returnStatistics = False,  url: str = None, token: str = None, whitelisted: bool = False):
     """
@@ -363,32 +933,32 @@ def get_all_observations(telescopeName: str = None, instrumentName: str = None,
         data : list
             List of observation ids
     """
-    request_counter = 0
+    if whitelisted is True:
+        status_code, observations = get_all_pages(
+            lambda pageNumber: get_observations(telescopeName = telescopeName, instrumentName = instrumentName, localizationDateobs = localizationDateobs , localizationName = localizationName, startDate = startDate, endDate = endDate, localizationCumprob = localizationCumprob, returnStatistics = returnStatistics, numPerPage = numPerPage, pageNumber = pageNumber, url = url, token = token),
+            numPerPage,
+        )
+        if status_code not in [200, 500]:
+            log.error("Error getting observations")
+        return status_code, observations
+
     finished = False
     pageNumber = 1
     observations = [] 
     while finished == False:
+        if whitelisted is False:
+            rate_limiter.wait()
         status_code, data = get_observations(telescopeName = telescopeName, instrumentName = instrumentName, localizationDateobs = localizationDateobs , localizationName = localizationName, startDate = startDate, endDate = endDate, localizationCumprob = localizationCumprob, returnStatistics = returnStatistics, numPerPage = numPerPage, pageNumber = pageNumber, url = url, token = token)
         if status_code == 200:
             if len(data) < numPerPage:
                 finished = True
-            if len(observations) == 0:
-                observations = data
-                pageNumber += 1
-            else:
-                observations.extend(data)
-                pageNumber += 1
+            observations.extend(data)
+            pageNumber += 1
         elif status_code == 500:
             finished = True
         else:
             finished = True
-            print("Error getting observations")
-
-        if whitelisted is False:
-            request_counter += 1
-            if request_counter > 10:
-                time.sleep(1) 
-                request_counter = 0
+            log.error("Error getting observations")
 
     return status_code, observations
 
@@ -450,11 +1020,8 @@ def get_observations(telescopeName: str = None, instrumentName: str = None, loca
     if instrumentName is not None:
         params["instrumentName"] = instrumentName
 
-    observations = api("GET", f"{url}/api/observation", params=params, token=token) 
-    data = [] 
-    if observations.status_code == 200:
-        data = observations.json()["data"]
-    return observations.status_code, data
+    observations = api("GET", f"{url}/api/observation", params=params, token=token)
+    return response_data(observations, [])
 
 def retrieve_observations(data: dict = {}, url: str = None, token: str = None):
     """
@@ -496,11 +1063,9 @@ def get_allocations(url: str = None, token: str = None):
             List of allocations
     """
     allocations = api("GET", f"{url}/api/allocation", token=token)
-    data = []
-    if allocations.status_code == 200:
-        data = allocations.json()["data"]
-    return allocations.status_code, data
+    return response_data(allocations, [])
 
+@memoize()
 def get_instruments(url: str = None, token: str = None):
     """
     Get all instruments from skyportal using its API
@@ -519,12 +1084,32 @@ def get_instruments(url: str = None, token: str = None):
             List of instruments
     """
     instruments = api("GET", f"{url}/api/instrument", token=token)
-    data = []
-    if instruments.status_code == 200:
-        data = instruments.json()["data"]
-    return instruments.status_code, data
+    return response_data(instruments, [])
 
-def get_instruments_from_ids(instrument_ids: list = None, url: str = None, token: str = None):
+@memoize()
+def get_instrument(instrument_id: int = None, url: str = None, token: str = None):
+    """
+    Get an instrument from skyportal using its API
+
+    Arguments
+    ----------
+        instrument_id : int
+            Instrument id
+        url : str
+            Skyportal url
+        token : str
+            Skyportal token
+    Returns
+    ----------
+        status_code : int
+            HTTP status code
+        data : dict
+            Instrument
+    """
+    instrument = api("GET", f"{url}/api/instrument/{instrument_id}", token=token)
+    return response_data(instrument)
+
+def get_instruments_from_ids(instrument_ids: list = None, url: str = None, token: str = None, whitelisted: bool = False):
     """
     Get all instruments from skyportal using its API
 
@@ -536,6 +1121,8 @@ def get_instruments_from_ids(instrument_ids: list = None, url: str = None, token
             Skyportal url
         token : str
             Skyportal token
+        whitelisted : bool
+            IP whitelisted on SkyPortal, no api calls limitation
     Returns
     ----------
         status_code : int
@@ -543,14 +1130,38 @@ def get_instruments_from_ids(instrument_ids: list = None, url: str = None, token
         data : list
             List of instruments
     """
-    status, all_instruments = get_instruments(url, token)
-    if status == 200:
-        instruments = [instrument for instrument in all_instruments if instrument['id'] in instrument_ids]
-    else:
-        instruments = []
-    
-    return status, instruments
+    return get_from_ids(get_instrument, instrument_ids, url, token, whitelisted)
+
+def get_instruments_and_telescopes_from_ids(instrument_ids: list = None, url: str = None, token: str = None, whitelisted: bool = False):
+    """
+    Get instruments and the telescopes they are on from skyportal using its API.
+
+    Arguments
+    ----------
+        instrument_ids : list
+            List of instrument ids
+        url : str
+            Skyportal url
+        token : str
+            Skyportal token
+        whitelisted : bool
+            IP whitelisted on SkyPortal, no api calls limitation
+    Returns
+    ----------
+        status_code : int
+            HTTP status code
+        instruments : list
+            List of instruments
+        telescopes : list
+            List of telescopes
+    """
+    instruments_status, instruments = get_instruments_from_ids(instrument_ids, url, token, whitelisted=whitelisted)
+    # still get the telescopes of the instruments that were found, even if some of them weren't
+    status, telescopes = get_telescopes_from_ids({instrument.get('telescope_id') for instrument in instruments}, url, token, whitelisted=whitelisted)
 
+    return (instruments_status if instruments_status != 200 else status), instruments, telescopes
+
+@memoize()
 def get_groups(url: str = None, token: str = None):
     """
     Get all groups from skyportal using its API
@@ -574,7 +1185,7 @@ def get_groups(url: str = None, token: str = None):
     groups = api("GET", f"{url}/api/groups", params=params, token=token)
     data = []
     if groups.status_code == 200:
-        data = groups.json()["data"]['all_groups']
+        data = response_json(groups)["data"]['all_groups']
     return groups.status_code, data
 
 def get_groups_from_ids(group_ids: list = None, url: str = None, token: str = None):
@@ -598,7 +1209,8 @@ def get_groups_from_ids(group_ids: list = None, url: str = None, token: str = No
     """
     status, all_groups = get_groups(url, token)
     if status == 200:
-        groups = [group for group in all_groups if group['id'] in group_ids]
+        ids = frozenset(group_ids)
+        groups = [group for group in all_groups if group['id'] in ids]
     else:
         groups = []
     
@@ -632,32 +1244,32 @@ def get_all_gcnevents(startDate: str = None, endDate: str = None, tagKeep: str =
         data : list
             List of source ids
     """
-    request_counter = 0
+    if whitelisted is True:
+        status_code, gcnevents = get_all_pages(
+            lambda pageNumber: get_gcnevents(startDate, endDate, tagKeep, tagRemove, numPerPage, pageNumber, url, token),
+            numPerPage,
+        )
+        if status_code not in [200, 500]:
+            log.error("Error getting sources")
+        return status_code, gcnevents
+
     finished = False
     pageNumber = 1
     gcnevents = [] 
     while finished == False:
+        if whitelisted is False:
+            rate_limiter.wait()
         status_code, data = get_gcnevents(startDate, endDate, tagKeep, tagRemove, numPerPage, pageNumber, url, token)
         if status_code == 200:
             if len(data) < numPerPage:
                 finished = True
-            if len(gcnevents) == 0:
-                gcnevents = data
-                pageNumber += 1
-            else:
-                gcnevents.extend(data) 
-                pageNumber += 1
+            gcnevents.extend(data)
+            pageNumber += 1
         elif status_code == 500:
             finished = True
         else:
             finished = True
-            print("Error getting sources") 
-
-        if whitelisted is False:
-            request_counter += 1
-            if request_counter > 10:
-                time.sleep(1) 
-                request_counter = 0
+            log.error("Error getting sources") 
 
     return status_code, gcnevents
 
@@ -712,7 +1324,7 @@ def get_gcnevents(startDate: str = None, endDate: str = None, tagKeep: str = Non
     gcnevents = api("GET", f"{url}/api/gcn_event", params=params, token=token)
     data = [] 
     if gcnevents.status_code == 200:
-        data = gcnevents.json()["data"]["events"]
+        data = response_json(gcnevents)["data"]["events"]
     return gcnevents.status_code, data
 
 def get_sources(localizationDateobs: str = None, localizationName: str = None, startDate: str = None, endDate: str = None, localizationCumprob: float = 0.95, numberDetections: int = 2, numPerPage: int = 100, pageNumber: int = 1, url: str = None, token: str = None):
@@ -745,6 +1357,8 @@ def get_sources(localizationDateobs: str = None, localizationName: str = None, s
             HTTP status code
         data : list
             List of source ids
+        totalMatches : int
+            Total number of sources matching the query
     """
 
     params = {
@@ -770,9 +1384,12 @@ def get_sources(localizationDateobs: str = None, localizationName: str = None, s
     
     sources = api("GET", f"{url}/api/sources", params=params, token=token)
     data = []
+    totalMatches = None
     if sources.status_code == 200:
-        data = sources.json()["data"]["sources"]
-    return sources.status_code, data
+        data = response_json(sources)["data"]
+        totalMatches = data.get("totalMatches")
+        data = data["sources"]
+    return sources.status_code, data, totalMatches
 
 def get_photometry(source_id: str = None, format: str = 'mag', url: str = None, token: str = None):
     """
@@ -794,12 +1411,10 @@ def get_photometry(source_id: str = None, format: str = 'mag', url: str = None,
     }
 
     photometry = api("GET", f"{url}/api/sources/{source_id}/photometry", params=params, token=token)
-    data = []
-    if photometry.status_code == 200:
-        data = photometry.json()["data"]
-        if len(data) == 0:
-            print(f"No photometry found for source {source_id}")
-    return photometry.status_code, data
+    status, data = response_data(photometry, [])
+    if status == 200 and len(data) == 0:
+        log.info(f"No photometry found for source {source_id}")
+    return status, data
 
 def get_all_sources_and_phot(localizationDateobs: str = None, localizationName: str = None, startDate: str = None, endDate: str = None, localizationCumprob: float = 0.95, numberDetections: int = 2, numPerPage: int = 100, url: str = None, token: str = None, whitelisted: bool = False):
     """
@@ -829,48 +1444,63 @@ def get_all_sources_and_phot(localizationDateobs: str = None, localizationName:
         data : list
             List of source ids
     """
-    request_counter = 0
+    def get_page(pageNumber):
+        if whitelisted is False:
+            rate_limiter.wait()
+        return get_sources(localizationDateobs, localizationName, startDate, endDate, localizationCumprob, numberDetections, numPerPage, pageNumber, url, token)
+
     finished = False
     pageNumber = 1
-    sources = []
+    # learn the number of pages from the first one, then fetch the others concurrently.
+    # Without whitelisting the rate limiter still spaces the calls, with fewer workers
+    status_code, sources, totalMatches = get_page(pageNumber)
+    if status_code == 200 and totalMatches is not None:
+        finished = True
+        n_pages = -(-int(totalMatches) // numPerPage)
+        with ThreadPoolExecutor(max_workers=8 if whitelisted is True else 4) as executor:
+            for status_code, data, _ in executor.map(get_page, range(2, n_pages + 1)):
+                if status_code != 200:
+                    if status_code != 500:
+                        log.error("Error getting sources")
+                    break
+                sources.extend(data)
+    elif status_code == 200:
+        # the server doesn't report totalMatches, page through sequentially
+        finished = len(sources) < numPerPage
+        pageNumber += 1
+    else:
+        finished = True
+        if status_code != 500:
+            log.error("Error getting sources")
+
     while finished == False:
-        status_code, data = get_sources(localizationDateobs, localizationName, startDate, endDate, localizationCumprob, numberDetections, numPerPage, pageNumber, url, token)
+        status_code, data, _ = get_page(pageNumber)
         if status_code == 200:
             if len(data) < numPerPage:
                 finished = True
-            if len(sources) == 0:
-                sources = data
-                pageNumber += 1
-            else:
-                sources.extend(data)
-                pageNumber += 1
+            sources.extend(data)
+            pageNumber += 1
         elif status_code == 500:
             finished = True
         else:
             finished = True
-            print("Error getting sources")
+            log.error("Error getting sources")
 
+    def get_source_photometry(source):
         if whitelisted is False:
-            request_counter += 1
-            if request_counter > 10:
-                time.sleep(1)
-                request_counter = 0
+            rate_limiter.wait()
+        return get_photometry(source["id"], url=url, token=token)
 
     if len(sources) > 0:
-        # get the photometry for each source
-        for source in sources:
-            status_code, photometry = get_photometry(source["id"], url=url, token=token)
-            if status_code == 200:
-                source["photometry"] = photometry
-            else:
-                print("Error getting photometry of source {}".format(source["id"]))
-
-            if whitelisted is False:
-                request_counter += 1
-                if request_counter > 10:
-                    time.sleep(1)
-                    request_counter = 0
-            
+        # fetch the photometry of several sources at once. Without whitelisting the rate limiter still spaces the calls,
+        # but a few workers keep the slow responses from delaying the next ones
+        with ThreadPoolExecutor(max_workers=16 if whitelisted is True else 4) as executor:
+            photometries = executor.map(get_source_photometry, sources)
+            for source, (status_code, photometry) in zip(sources, photometries):
+                if status_code == 200:
+                    source["photometry"] = photometry
+                else:
+                    log.error("Error getting photometry of source {}".format(source["id"]))
 
     return status_code, sources
 
@@ -878,39 +1508,16 @@ def formattedSource(source):
     """
     Keep only the fields that are needed.
     """
-    formatted_source = {}
-    for field in source_fields:
-        if field in source:
-            formatted_source[field] = source[field]
-        else:
-            formatted_source[field] = None
+    formatted_source = {field: source.get(field) for field in source_fields}
     formatted_source['group_ids'] = ["=public_group_id"]
     
     return formatted_source
 
-def formattedPhot(photometry):
-    """
-    Keep only the fields that are needed.
-    """
-    formatted_phot = {}
-    for field in photometry_fields:
-        if field in photometry:
-            formatted_phot[field] = photometry[field]
-        else:
-            formatted_phot[field] = None
-    
-    return formatted_phot
-
 def formattedPhotRef(photometryRef, instrument_yaml_ids: dict = None):
     """
     Keep only the fields that are needed.
     """
-    formatted_phot_ref = {}
-    for field in photometry_ref_fields:
-        if field in photometryRef:
-            formatted_phot_ref[field] = photometryRef[field]
-        else:
-            formatted_phot_ref[field] = None
+    formatted_phot_ref = {field: photometryRef.get(field) for field in photometry_ref_fields}
 
     formatted_phot_ref['group_ids'] = ["=public_group_id"]
 
@@ -919,6 +1526,15 @@ def formattedPhotRef(photometryRef, instrument_yaml_ids: dict = None):
     
     return formatted_phot_ref
 
+def write_photometry_csv(file_path: str, photometry: list):
+    """
+    Write the photometry of a source, for one instrument, to a csv file.
+    """
+    with open(file_path, 'w', newline='', encoding='utf-8', buffering=1 << 20) as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(photometry_fields)
+        writer.writerows([phot.get(field) for field in photometry_fields] for phot in photometry)
+
 def seperate_sources_from_phot(data: list, directory: str = None):
     """
     Separates sources and photometry
@@ -935,41 +1551,49 @@ def seperate_sources_from_phot(data: list, directory: str = None):
         photometry : list
             List of photometry
     """
-    instrument_ids_full_list = []
+    instrument_ids_full_list = set()
     source_list_to_yaml = []
     photometry_list_to_yaml = []
-    for source in data:
-        source_list_to_yaml.append(formattedSource(source))
-        # seperate the photometry by instrument
-        if len(source["photometry"]) > 0:
-            photometry_dict = {}
-            for phot in source["photometry"]:
-                instrument_id = phot['instrument_id']
-                if instrument_id not in photometry_dict.keys():
-                    photometry_dict[instrument_id] = {
-                        "instrument_name": phot['instrument_name'],
-                        "photometry": []
-                    }
-                photometry_dict[instrument_id]["photometry"].append(formattedPhot(phot))
-
-            for instrument in photometry_dict:
-                    photometry_dict[instrument]["photometry"].sort(key=lambda x: x["mjd"])
-                    # remove duplicates. A duplicate is when there is the same mjd, mag, magerr
+    photometry_directory = f"{directory}/photometry"
+    os.makedirs(photometry_directory, exist_ok=True)
+    # the csv files are written by a pool of threads while the next sources are processed
+    writes = []
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for source in data:
+            source_list_to_yaml.append(formattedSource(source))
+            # the raw photometry is only needed to write the csv files, drop it from the source so it can be freed once written
+            photometry = source.pop("photometry", [])
+            # seperate the photometry by instrument
+            if len(photometry) > 0:
+                # the instruments are listed in the order they first appear in, before sorting
+                photometry_dict = dict.fromkeys(phot['instrument_id'] for phot in photometry)
+                # sorted once for the whole source, the buckets keep that order
+                photometry.sort(key=operator.itemgetter("mjd"))
+                for phot in photometry:
+                    instrument_id = phot['instrument_id']
+                    bucket = photometry_dict[instrument_id]
+                    if bucket is None:
+                        bucket = photometry_dict[instrument_id] = {
+                            "instrument_name": phot['instrument_name'],
+                            "photometry": []
+                        }
+                    # the points are kept as they are, only the fields that are needed are read when writing the csv file
+                    bucket["photometry"].append(phot)
+
+                for instrument, bucket in photometry_dict.items():
+                    # remove duplicates. A duplicate is when there is the same mjd, mag, magerr, limiting_mag and filter
+                    seen = set()
                     temp_photometry = []
-                    for phot in photometry_dict[instrument]["photometry"]:
-                        if any(x["mjd"] == phot["mjd"] and x["mag"] == phot["mag"] and x["magerr"] == phot["magerr"] and x["limiting_mag"] == phot["limiting_mag"] and x["filter"] == phot["filter"] for x in temp_photometry):
-                            continue
-                        else:
+                    for phot in bucket["photometry"]:
+                        key = (phot["mjd"], phot.get("mag"), phot.get("magerr"), phot.get("limiting_mag"), phot.get("filter"))
+                        if key not in seen:
+                            seen.add(key)
                             temp_photometry.append(phot)
-                    photometry_dict[instrument]["photometry"] = temp_photometry
-                    filename = source['id'] + "_" + str(photometry_dict[instrument]['instrument_name']) + ".csv"
+                    bucket["photometry"] = temp_photometry
+                    filename = f"{source['id']}_{bucket['instrument_name']}.csv"
                     # save file
-                    with open(f"{directory}/photometry/{filename}", 'w') as csvfile:
-                        writer = csv.writer(csvfile)
-                        writer.writerow(photometry_fields)
-                        for phot in photometry_dict[instrument]["photometry"]:
-                            writer.writerow([phot[field] for field in photometry_fields])
-                    
+                    writes.append(executor.submit(write_photometry_csv, f"{photometry_directory}/{filename}", bucket["photometry"]))
+
                     photometry_list_to_yaml.append({
                         'obj_id': source['id'],
                         'instrument_id': instrument,
@@ -977,30 +1601,29 @@ def seperate_sources_from_phot(data: list, directory: str = None):
                         'file': "photometry/" + filename
                     })
 
-            instrument_ids_full_list.extend(list(photometry_dict.keys()))
-            instrument_ids_full_list = list(set(instrument_ids_full_list))
+                instrument_ids_full_list.update(photometry_dict)
 
+    for write in writes:
+        # raises if a file couldn't be written
+        write.result()
 
-    return source_list_to_yaml, photometry_list_to_yaml, instrument_ids_full_list
+    return source_list_to_yaml, photometry_list_to_yaml, list(instrument_ids_full_list)
 
 def formattedFollowupRequest(followupRequest, index):
     """
     Keep only the fields that are needed.
     """
-    print(followupRequest)
-    formatted_followup = {}
-    for field in followups_fields:
-        if field in followupRequest:
-            formatted_followup[field] = followupRequest[field]
+    log.debug(followupRequest)
+    formatted_followup = {field: followupRequest[field] for field in followups_fields if field in followupRequest}
 
     formatted_followup['=id'] = f"request_{index}"
     formatted_followup['allocation_id'] = f"={followupRequest['allocation']['pi'].strip()}_{followupRequest['allocation']['instrument']['name'].strip()}_{followupRequest['allocation']['start_date'].strip()}_{followupRequest['allocation']['end_date'].strip()}_{str(followupRequest['allocation']['hours_allocated']).strip()}"
 
     time_fields = ['start_date', 'end_date']
     for field in time_fields:
-        print(formatted_followup['payload'][field])
+        log.debug(formatted_followup['payload'][field])
         formatted_followup['payload'][field] = datetime.strptime(formatted_followup['payload'][field], '%Y-%m-%d')
-        print(formatted_followup['payload'][field])
+        log.debug(formatted_followup['payload'][field])
 
     
     return formatted_followup
@@ -1010,55 +1633,57 @@ def get_followup_requests(instrument_id: int = None, source_id: str = None, star
     Get the followup requests for a source.
     """
 
-    params = {
-            "pageNumber": pageNumber,
-            "numPerPage": numPerPage,
-        }
-        
     if output_format not in [None, 'png', 'pdf', 'csv']:
         raise ValueError("If you specify an output format, it must be one of: 'png', 'pdf', 'csv'")
-    
-    if instrument_id is not None:
-        params["instrumentID"] = instrument_id
-    if source_id is not None:
-        params["sourceID"] = source_id
-    if startDate is not None:
-        params["startDate"] = startDate
-    if endDate is not None:
-        params["endDate"] = endDate
-    if status is not None:
-        params["status"] = status
 
-    headers = {'Authorization': f'token {token}'}
-    response = requests.get(f"{url}/api/followup_request", params=params, headers=headers)
+    params = {
+        "pageNumber": pageNumber,
+        "numPerPage": numPerPage,
+        "instrumentID": instrument_id,
+        "sourceID": source_id,
+        "startDate": startDate,
+        "endDate": endDate,
+        "status": status,
+    }
+    params = {key: value for key, value in params.items() if value is not None}
+
+    response = api("GET", f"{url}/api/followup_request", params=params, token=token)
     status = response.status_code
     if status == 200:
-        return status, [] if response.json()["data"] is None else response.json()["data"]
+        data = response_json(response)["data"]
+        return status, [] if data is None else data
     else:
         return status, None
 
-def get_all_followup_requests(instrument_id: int = None, source_id: str = None, startDate: str = None, endDate: str = None, status: str = None, observationStartDate: str = None, observationEndDate: str = None, output_format: str = None, url: str = None, token: str = None):
+def get_all_followup_requests(instrument_id: int = None, source_id: str = None, startDate: str = None, endDate: str = None, status: str = None, observationStartDate: str = None, observationEndDate: str = None, output_format: str = None, url: str = None, token: str = None, whitelisted: bool = False, numPerPage: int = 100):
     """
     Get all the followup requests for a source.
     """
 
     pageNumber = 1
-    numPerPage = 100
+    if numPerPage is None:
+        numPerPage = 100
     all_followups = []
+
+    def get_page(pageNumber):
+        if whitelisted is False:
+            rate_limiter.wait()
+        return get_followup_requests(instrument_id, source_id, startDate, endDate, None, observationStartDate, observationEndDate, output_format, pageNumber, numPerPage, url, token)
     
-    status, followups = get_followup_requests(instrument_id, source_id, startDate, endDate, None, observationStartDate, observationEndDate, output_format, pageNumber, numPerPage, url, token)
+    status, followups = get_page(pageNumber)
     if status != 200:
         return status, None, None
     else:
         all_followups = followups['followup_requests']
         totalMatches = followups['totalMatches']
-        while int(pageNumber*numPerPage) < int(totalMatches):
-            pageNumber += 1
-            status, followups = get_followup_requests(instrument_id, source_id, startDate, endDate, None, observationStartDate, observationEndDate, output_format, pageNumber, numPerPage, url, token)
-            if status != 200:
-                return status, None, None
-            else:
-                all_followups.extend(followups['followup_requests'])
+        # the number of pages is known from the first one, fetch the others concurrently
+        n_pages = -(-int(totalMatches) // numPerPage)
+        with ThreadPoolExecutor(max_workers=8 if whitelisted is True else 4) as executor:
+            for status, followups in executor.map(get_page, range(2, n_pages + 1)):
+                if status != 200:
+                    return status, None, None
+                else:
+                    all_followups.extend(followups['followup_requests'])
         return status, all_followups, totalMatches
     
 
@@ -1069,12 +1694,11 @@ def get_allocations(instrument_id: int = None, url: str = None, token: str = Non
 
     response = api('GET', f"{url}/api/allocation/{instrument_id}", token=token)
     status = response.status_code
-    data = []
-    if response.json()["data"] is not None:
-        if isinstance(response.json()["data"], list):
-            data = response.json()["data"]
-        else:
-            data = [response.json()["data"]]
+    data = response_json(response)["data"]
+    if data is None:
+        data = []
+    elif not isinstance(data, list):
+        data = [data]
     if status == 200:
         return status, data
     else:
@@ -1084,10 +1708,7 @@ def formattedAllocation(allocation: dict = None, instrument_yaml_ids: list = Non
     """
     Format the allocations
     """
-    formatted_allocation = {}
-    for field in allocation_fields:
-        if field in allocation:
-            formatted_allocation[field] = allocation[field]
+    formatted_allocation = {field: allocation[field] for field in allocation_fields if field in allocation}
     formatted_allocation['=id'] = f"{allocation['pi'].strip()}_{instrument_yaml_ids[allocation['instrument_id']]}_{allocation['start_date'].strip()}_{allocation['end_date'].strip()}_{str(allocation['hours_allocated']).strip()}"
     formatted_allocation['instrument_id'] = f"={instrument_yaml_ids[allocation['instrument_id']]}"
     formatted_allocation['group_id'] = f"=public_group_id"